@@ -0,0 +1,121 @@
+# MeshCore packet parsing used by wardrive-mqtt.py.
+# This module has no I/O or third-party imports so it can be compiled
+# with mypyc (`mypyc packet_parse.py`). Python picks up the compiled
+# module if it's there, otherwise this file is used as-is.
+import struct
+
+# Packet layouts.
+TRANSPORT_CODES = struct.Struct("<HH")
+ADVERT_HEADER = struct.Struct("<B31xI64xB")  # pubkey[0], timestamp, flags
+ADVERT_LATLON = struct.Struct("<ii")
+
+DIGITS = b"0123456789"
+HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+
+
+# Returns the advert field offsets for a flags value as (latlon_offset, name_offset).
+# An offset is None when the flags say the field isn't present.
+def advert_layout(flags: int) -> tuple[int | None, int | None]:
+  offset = ADVERT_HEADER.size
+  latlon_offset = None
+  name_offset = None
+  if flags & 0x10: # ADV_LATLON_MASK
+    latlon_offset = offset
+    offset += ADVERT_LATLON.size
+  if flags & 0x20: # ADV_FEAT1_MASK
+    offset += 2
+  if flags & 0x40: # ADV_FEAT2_MASK
+    offset += 2
+  if flags & 0x80: # ADV_NAME_MASK
+    name_offset = offset
+  return (latlon_offset, name_offset)
+
+# Layouts only depend on the optional field bits in the upper nibble.
+ADVERT_LAYOUT = tuple(advert_layout(high << 4) for high in range(16))
+
+
+# Decodes UTF8 characters and removes null padding bytes.
+def to_utf8(data: bytes) -> str:
+  return data.translate(None, b"\0").decode("utf-8", "ignore")
+
+
+# Parses a "[+-]123[.456]" coordinate token. Returns None if it isn't one.
+def parse_coord(token: bytes) -> float | None:
+  digits = token[1:] if token[:1] in (b"+", b"-") else token
+  if not digits.replace(b".", b"", 1).isdigit(): return None
+  return float(token)
+
+
+# Finds the first "<lat>[,] <lon> [<ignored id>]" in the message text.
+# Returns (lat, lon, ignored id bytes) or None if there isn't one.
+def find_coords(text: bytes) -> tuple[float, float, bytes | None] | None:
+  # Most channel messages are plain text, skip those without tokenizing.
+  if len(text.translate(None, DIGITS)) == len(text): return None
+
+  tokens = text.split()
+  count = len(tokens)
+
+  for i in range(count - 1):
+    lat = parse_coord(tokens[i].removesuffix(b","))
+    if lat is None: continue
+
+    # Allow the comma to be separated from the numbers.
+    j = i + 1
+    if tokens[j] == b"," and j + 1 < count: j += 1
+
+    lon = parse_coord(tokens[j])
+    if lon is None: continue
+
+    ignored = tokens[j + 1] if j + 1 < count else b""
+    if len(ignored) == 2 and HEX_DIGITS.issuperset(ignored):
+      return (lat, lon, bytes.fromhex(ignored.decode()))
+    return (lat, lon, None)
+
+  return None
+
+
+# Splits a MeshCore packet into its (path, payload).
+def parse_packet(raw: bytes) -> tuple[bytes, bytes]:
+  # see https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/Packet.h
+  buf = memoryview(raw)
+  route_type = buf[0] & 0x3
+  offset = 1
+
+  # Skip transport codes on transport route types.
+  if route_type in [0, 3]:
+    offset += TRANSPORT_CODES.size
+
+  path_len = buf[offset]
+  offset += 1
+  path = bytes(buf[offset:offset + path_len])
+  payload = bytes(buf[offset + path_len:])
+  return (path, payload)
+
+
+# Parses an ADVERT payload. Returns (id, name, lat, lon) for
+# repeater adverts or None for any other advert type.
+def parse_advert(payload: bytes) -> tuple[str, str, float, float] | None:
+  # See https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/Mesh.cpp#L231
+  # See https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/helpers/AdvertDataHelpers.cpp#L29
+
+  # Only the first pubkey byte (the repeater id) is used.
+  key_byte, timestamp, flags = ADVERT_HEADER.unpack_from(payload)
+  type = flags & 0xF # ADV_TYPE_MASK
+
+  # Only care about repeaters (2).
+  if type != 2: return None
+
+  id = f"{key_byte:02x}"
+  lat = 0.0
+  lon = 0.0
+  name = ""
+  latlon_offset, name_offset = ADVERT_LAYOUT[flags >> 4]
+
+  if latlon_offset is not None:
+    lat_e6, lon_e6 = ADVERT_LATLON.unpack_from(payload, latlon_offset)
+    lat = lat_e6 / 1e6
+    lon = lon_e6 / 1e6
+  if name_offset is not None:
+    name = to_utf8(payload[name_offset:])
+
+  return (id, name, lat, lon)
@@ -5,9 +5,12 @@ import os
 # to the previous placeholder if not set.
 HOST = os.environ.get('SERVICE_HOST', 'https://ct-mesh-map.pages.dev')
 
+# Share one connection across the maintenance calls.
+SESSION = requests.Session()
+
 def consolidate():
   try:
-    resp = requests.get(HOST + "/consolidate")
+    resp = SESSION.get(HOST + "/consolidate")
     resp.raise_for_status()
     data = resp.json()
     print(f"Consolidate returned {data}, response: {resp.status_code}")
@@ -17,7 +20,7 @@ def consolidate():
 
 def clean_up():
   try:
-    resp = requests.get(HOST + "/clean-up?op=repeaters")
+    resp = SESSION.get(HOST + "/clean-up?op=repeaters")
     resp.raise_for_status()
     data = resp.json()
     print(f"Clean-up returned {data}, response: {resp.status_code}")
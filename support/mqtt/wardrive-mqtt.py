@@ -1,14 +1,19 @@
-import io
 import json
+import math
+import orjson
 import os
 import paho.mqtt.client as mqtt
+import queue
 import re
 import requests
 import ssl
+import threading
 
-from collections import deque
+from collections import OrderedDict
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from haversine import haversine, Unit
+from packet_parse import find_coords, parse_advert, parse_packet
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Globals
 CONFIG = json.load(open("config.json"))
@@ -16,21 +21,51 @@ CENTER_POSITION = tuple(CONFIG["center_position"])
 VALID_DIST = CONFIG["valid_dist"]
 CHANNEL_HASH = CONFIG["channel_hash"]
 CHANNEL_SECRET = bytes.fromhex(CONFIG["channel_secret"])
+CHANNEL_CIPHER = Cipher(algorithms.AES(CHANNEL_SECRET), modes.ECB())
+WATCHED_OBSERVERS = frozenset(CONFIG["watched_observers"])
+WATCHED_PACKET_TYPES = frozenset(["4", "5"])  # ADVERT, GROUP_MSG
 
 SERVICE_HOST = CONFIG["service_host"]
 ADD_REPEATER_URL = "/put-repeater"
 ADD_SAMPLE_URL = "/put-sample"
 
-SEEN = deque(maxlen=100)
-COORD_PAIR = re.compile(
-  r"""
-  (?P<lat>[+-]?\d+(?:\.\d+)?)        # latitude number
-  \s*,?\s+                           # whitespace (optional comma)
-  (?P<lon>[+-]?\d+(?:\.\d+)?)        # longitude number
-  (\s+(?P<ignored>[0-9a-fA-F]{2}))?  # optional ignored repeater id
-  """,
-  re.VERBOSE,
-)
+# Messages are handled off the MQTT network thread, in order
+# on a single thread so SEEN doesn't need locking.
+MESSAGE_QUEUE = queue.Queue(maxsize=1000)
+
+# Uploads are sent by worker threads so a slow service
+# doesn't stall the MQTT loop.
+UPLOAD_QUEUE = queue.Queue(maxsize=1000)
+UPLOAD_WORKERS = 4
+
+# Reuse connections to the service across uploads.
+JSON_HEADERS = {"Content-Type": "application/json"}
+SESSION = requests.Session()
+SESSION.mount(SERVICE_HOST, HTTPAdapter(
+  pool_connections=1,
+  pool_maxsize=UPLOAD_WORKERS,
+  max_retries=Retry(total=2, backoff_factor=0.3)))
+
+# Distance check constants. Over VALID_DIST the earth is flat
+# enough for an equirectangular distance, so no trig per sample.
+CENTER_LAT, CENTER_LON = CENTER_POSITION
+MILES_PER_DEGREE_LAT = 3958.7613 * math.pi / 180
+MILES_PER_DEGREE_LON = MILES_PER_DEGREE_LAT * math.cos(math.radians(CENTER_LAT))
+MAX_DLAT = VALID_DIST / MILES_PER_DEGREE_LAT
+MAX_DLON = VALID_DIST / MILES_PER_DEGREE_LON
+MAX_DIST_SQ = VALID_DIST * VALID_DIST
+
+# Raw message prefilters, checked before parsing the JSON.
+# Observer names may be sent as plain UTF-8 or as JSON escapes.
+PACKET_TYPE_FILTER = re.compile(rb'"packet_type"\s*:\s*"[45]"')
+WATCHED_OBSERVER_FILTER = tuple({
+  form
+  for name in WATCHED_OBSERVERS
+  for form in (name.encode(), json.dumps(name)[1:-1].encode())
+})
+
+SEEN = OrderedDict()  # Used as a bounded set, oldest first.
+SEEN_MAX = 100
 
 
 # Returns true if the specified location is valid for upload.
@@ -39,9 +74,18 @@ def is_valid_location(lat: float, lon: float):
     print(f"Invalid position data {(lat, lon)}")
     return False
 
-  distance = haversine(CENTER_POSITION, (lat, lon), unit=Unit.MILES) 
-  if (distance > VALID_DIST):
-    print(f"{(lat, lon)} distance {distance} exceeds max distance")
+  # Cheap bounding box check first.
+  dlat = lat - CENTER_LAT
+  dlon = lon - CENTER_LON
+  if (abs(dlat) > MAX_DLAT or abs(dlon) > MAX_DLON):
+    print(f"{(lat, lon)} outside max distance bounds")
+    return False
+
+  dy = dlat * MILES_PER_DEGREE_LAT
+  dx = dlon * MILES_PER_DEGREE_LON
+  dist_sq = dx * dx + dy * dy
+  if (dist_sq > MAX_DIST_SQ):
+    print(f"{(lat, lon)} distance {math.sqrt(dist_sq)} exceeds max distance")
     return False
 
   return True
@@ -50,23 +94,39 @@ def is_valid_location(lat: float, lon: float):
 # Sends data to the specified url with error logging.
 def post_to_service(url, data):
   try:
-    resp = requests.post(url, json=data, timeout=5)
+    resp = SESSION.post(url, data=orjson.dumps(data), headers=JSON_HEADERS, timeout=5)
     resp.raise_for_status()
     print(f"Sent {data} response: {resp.status_code}")
   except requests.RequestException as e:
       print(f"POST {data} failed:{e}")
 
 
+# Queues data to be sent to the specified url, dropping it if the queue is full.
+def queue_upload(url, data):
+  try:
+    UPLOAD_QUEUE.put_nowait((url, data))
+  except queue.Full:
+    print(f"Upload queue full, dropping {data}")
+
+
+# Sends queued uploads to the service.
+def upload_worker():
+  while True:
+    url, data = UPLOAD_QUEUE.get()
+    post_to_service(url, data)
+    UPLOAD_QUEUE.task_done()
+
+
 # Uploads an observed sample to the service.
-def upload_sample(lat: float, lon: float, path: list[str]):
+def upload_sample(lat: float, lon: float, path: list[bytes]):
   payload = {
     "lat": lat,
     "lon": lon,
-    "path": path,
+    "path": [id.hex() for id in path],
     "observed": True
   }
   url = SERVICE_HOST + ADD_SAMPLE_URL
-  post_to_service(url, payload)
+  queue_upload(url, payload)
 
 
 # Uploads a repeater update to the service.
@@ -79,90 +139,33 @@ def upload_repeater(id: str, name: str, lat: float, lon: float):
     "path": []
   }
   url = SERVICE_HOST + ADD_REPEATER_URL
-  post_to_service(url, payload)
+  queue_upload(url, payload)
 
 
-# Decrypts a payload using the given secret.
-def decrypt(secret: bytes, encrypted: bytes) -> bytes:
-  cipher = Cipher(algorithms.AES(secret), modes.ECB())
+# Decrypts a payload using the given cipher.
+def decrypt(cipher: Cipher, encrypted: bytes) -> bytes:
   decryptor = cipher.decryptor()
   return decryptor.update(encrypted) + decryptor.finalize()
 
 
-# Decodes UTF8 characters and removes null padding bytes.
-def to_utf8(data: bytes) -> str:
-  return data.decode("utf-8", "ignore").replace("\0", "")
-
-
-# Builds a MeshCore packet from raw bytes.
-def make_packet(raw: str):
-  # see https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/Packet.h
-  buf = io.BytesIO(bytes.fromhex(raw))
-  header = buf.read(1)[0]
-  route_type = header & 0x3
-  packet_type = header >> 2 & 0xF
-  transport_codes = [0, 0]
-
-  # Read transport codes from transport route types.
-  if route_type in [0, 3]:
-    transport_codes[0] = int.from_bytes(buf.read(2), byteorder="little")
-    transport_codes[1] = int.from_bytes(buf.read(2), byteorder="little")
-
-  path_len = buf.read(1)[0]
-  path = buf.read(path_len).hex()
-  payload = buf.read()
-  return {
-    "transport_codes": transport_codes,
-    "route_type": route_type,
-    "packet_type": packet_type,
-    "path_len": path_len,
-    "path": path,
-    "payload": payload
-  }
-
-
 # Handle an ADVERT packet.
-def handle_advert(packet):
-  # See https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/Mesh.cpp#L231
-  # See https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/helpers/AdvertDataHelpers.cpp#L29
-  payload = io.BytesIO(packet["payload"])
-
-  pubkey = payload.read(32).hex()
-  timestamp = int.from_bytes(payload.read(4), byteorder="little")
-  signature = payload.read(64).hex()
-  flags = payload.read(1)[0]
-  type = flags & 0xF # ADV_TYPE_MASK
-
-  # Only care about repeaters (2).
-  if type != 2: return
-
-  id = pubkey[0:2]
-  lat = 0
-  lon = 0
-  name = ""
-
-  if flags & 0x10: # ADV_LATLON_MASK
-    lat = int.from_bytes(payload.read(4), byteorder="little", signed=True) / 1e6
-    lon = int.from_bytes(payload.read(4), byteorder="little", signed=True) / 1e6
-  if flags & 0x20: # ADV_FEAT1_MASK
-    payload.read(2)
-  if flags & 0x40: # ADV_FEAT2_MASK
-    payload.read(2)
-  if flags & 0x80: # ADV_NAME_MASK
-    name = to_utf8(payload.read())
+def handle_advert(payload: bytes):
+  repeater = parse_advert(payload)
 
+  # Only care about repeaters.
+  if not repeater: return
+
+  id, name, lat, lon = repeater
   if is_valid_location(lat, lon):
     upload_repeater(id, name, lat, lon)
 
 
 # Handle a GROUP_MSG packet.
-def handle_channel_msg(packet):
+def handle_channel_msg(path: bytes, payload: bytes):
   # See https://github.com/meshcore-dev/MeshCore/blob/9405e8bee35195866ad1557be4af5f0c140b6ad1/src/Mesh.cpp#L206C1-L206C33
-  payload = io.BytesIO(packet["payload"])
-  
-  channel_hash = payload.read(1).hex()
-  mac = payload.read(2)
-  encrypted = payload.read()
+  channel_hash = payload[0:1].hex()
+  mac = payload[1:3]
+  encrypted = payload[3:]
 
   # Encrypted data truncated.
   if len(encrypted) % 16 != 0: return
@@ -171,28 +174,26 @@ def handle_channel_msg(packet):
   if channel_hash != CHANNEL_HASH: return
 
   # TODO: technically should check the HMAC here.
-  data = decrypt(CHANNEL_SECRET, encrypted)
+  data = decrypt(CHANNEL_CIPHER, encrypted)
 
   # Data wasn't decrypted or complete.
   if len(data) <= 4: return
 
-  plain_text = to_utf8(data[5:]).lower()
-  first_repeater = packet['path'][0:2]
-  match = re.search(COORD_PAIR, plain_text)
+  # Scan the message bytes directly, no need to decode the text.
+  first_repeater = path[0:1]
+  coords = find_coords(data[5:].rstrip(b"\0"))
 
   # Not a lat/lon sample.
-  if not match: return
+  if not coords: return
 
-  lat = float(match.group('lat'))
-  lon = float(match.group('lon'))
-  ignored = match.group('ignored')
+  lat, lon, ignored = coords
 
   # First path should be ignored (mobile repeater case).
   if first_repeater == ignored:
-    first_repeater = packet['path'][2:4]
-    print(f"Ignoring first hop {ignored}, using {first_repeater}")
+    first_repeater = path[1:2]
+    print(f"Ignoring first hop {ignored.hex()}, using {first_repeater.hex()}")
 
-  if is_valid_location(lat, lon) and first_repeater != '':
+  if is_valid_location(lat, lon) and first_repeater:
     upload_sample(lat, lon, [first_repeater])
 
 
@@ -215,10 +216,24 @@ def on_disconnect(client, userdata, flags, reason_code, properties = None):
 
 # Callback when a PUBLISH message is received from the broker.
 def on_message(client, userdata, msg):
+  # Skip the JSON parsing for messages that can't be an advert
+  # or group message from one of the watched observers.
+  body = msg.payload
+  if not PACKET_TYPE_FILTER.search(body): return
+  if not any(name in body for name in WATCHED_OBSERVER_FILTER): return
+
+  try:
+    MESSAGE_QUEUE.put_nowait(body)
+  except queue.Full:
+    print("Message queue full, dropping message")
+
+
+# Handles a queued PUBLISH message body.
+def handle_message(body: bytes):
   data = {}
-  
+
   try:
-    data = json.loads(msg.payload.decode())
+    data = orjson.loads(body)
 
     # Don't reprocess packets for now. Might be worth
     # extracting other paths at some point. That requires
@@ -227,34 +242,41 @@ def on_message(client, userdata, msg):
     if (packet_hash is None or packet_hash in SEEN): return
 
     # Is this one of the "authoritative" observers in the region?
-    if data["origin"] not in CONFIG["watched_observers"]: return
+    if data["origin"] not in WATCHED_OBSERVERS: return
 
     # Is this an advert (4) or group message (5)?
     packet_type = data["packet_type"]
-    if packet_type not in ["4", "5"]: return
+    if packet_type not in WATCHED_PACKET_TYPES: return
 
-    # Parse the outer packet.
-    raw = data["raw"]
-    packet = make_packet(data["raw"])
+    # Parse the outer packet. The hex is decoded once here and
+    # the parsers work on slices of the same buffer.
+    path, payload = parse_packet(bytes.fromhex(data["raw"]))
 
     # Messages won't have the observer in the path.
     # Append the observer's id to the path.
-    packet["path"] += data["origin_id"][0:2].lower()
-    packet["path_len"] += 2
+    path += bytes.fromhex(data["origin_id"][0:2])
 
     # Handle the app-specific payload.
     if packet_type == "4":
-      handle_advert(packet)
+      handle_advert(payload)
     elif packet_type == "5":
-      handle_channel_msg(packet)
+      handle_channel_msg(path, payload)
 
     # All done, mark this hash 'seen'.
-    SEEN.append(packet_hash)
+    SEEN[packet_hash] = None
+    if len(SEEN) > SEEN_MAX:
+      SEEN.popitem(last=False)
   except Exception as e:
     print(f"Error handling message: {e}")
     print(f">> {data}")
 
 
+# Handles queued messages in the order they were received.
+def message_worker():
+  while True:
+    handle_message(MESSAGE_QUEUE.get())
+
+
 def main():
   # Initialize the MQTT client
   client = mqtt.Client(
@@ -270,10 +292,14 @@ def main():
   client.on_disconnect = on_disconnect
   client.on_message = on_message
 
+  for _ in range(UPLOAD_WORKERS):
+    threading.Thread(target=upload_worker, daemon=True).start()
+
   try:
     print(f"Connecting to {CONFIG['mqtt_host']}:{CONFIG['mqtt_port']}");
     client.connect(CONFIG["mqtt_host"], CONFIG["mqtt_port"], 60)
-    client.loop_forever()
+    client.loop_start()
+    message_worker()
   except Exception as e:
     print(f"An error occurred: {e}")
 